@@ -1,24 +1,432 @@
 #!/usr/bin/env python3
 
+import array
+import concurrent.futures
+import csv
+import functools
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
 import pathlib
+import stat
+import sys
 import click
 
+# Bytes XORed per step.  Each step turns both sides into one big int, so this
+# bounds memory use while keeping the per-byte work inside C.
+CHUNK_SIZE = 1 << 20
+
+
+def is_stream(path):
+    # Anything that isn't a regular file (stdin, pipes, process substitution,
+    # devices) is read front to back instead of mapped.
+    if path == pathlib.Path("-"):
+        return True
+    return not stat.S_ISREG(path.stat().st_mode)
+
+
+def open_stream(path):
+    if path == pathlib.Path("-"):
+        return open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    return path.open("rb", buffering=0)
+
+
+def read_full(f, buf):
+    # Pipes return short reads, so keep going until the buffer is full or EOF.
+    view = memoryview(buf)
+    filled = 0
+    while filled < len(buf):
+        n = f.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return view[:filled]
+
+
+def open_mapped(path):
+    with path.open("rb") as f:
+        # mmap refuses zero-length files.
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+@functools.cache
+def bit_position_masks():
+    # One mask per bit position, selecting that bit of every byte in a chunk.
+    return [
+        int.from_bytes(bytes([1 << bit]) * CHUNK_SIZE, "little") for bit in range(8)
+    ]
+
+
+def count_bits_differing(a_chunk, b_chunk, positions=None):
+    a_int = int.from_bytes(a_chunk, "little")
+    b_int = int.from_bytes(b_chunk, "little")
+    xor = a_int ^ b_int
+    if positions is not None:
+        for bit, mask in enumerate(bit_position_masks()):
+            positions[bit] += (xor & mask).bit_count()
+    return xor.bit_count()
+
+
+def count_range(a_map, b_map, start, stop, positions=None):
+    bitsdiff = 0
+    for offset in range(start, stop, CHUNK_SIZE):
+        end = min(offset + CHUNK_SIZE, stop)
+        bitsdiff += count_bits_differing(
+            a_map[offset:end], b_map[offset:end], positions
+        )
+    return bitsdiff
+
+
+def count_blocks(a_map, b_map, start, stop, block_size, positions=None):
+    counts = array.array("Q")
+    for offset in range(start, stop, block_size):
+        end = min(offset + block_size, stop)
+        counts.append(count_range(a_map, b_map, offset, end, positions))
+    return counts
+
+
+def new_positions(by_position):
+    return [0] * 8 if by_position else None
+
+
+def add_positions(positions, more):
+    if positions is not None:
+        for bit, count in enumerate(more):
+            positions[bit] += count
+
+
+def count_path_range(a, b, start, stop, by_position):
+    positions = new_positions(by_position)
+    bitsdiff = count_range(open_mapped(a), open_mapped(b), start, stop, positions)
+    return bitsdiff, positions
+
+
+def count_path_blocks(a, b, start, stop, block_size, by_position):
+    positions = new_positions(by_position)
+    counts = count_blocks(
+        open_mapped(a), open_mapped(b), start, stop, block_size, positions
+    )
+    return counts, positions
+
+
+def split_ranges(length, pieces, align=CHUNK_SIZE):
+    step = -(-length // pieces)
+    step = max(align, -(-step // align) * align)
+    return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+def count_parallel(a, b, length, jobs, positions=None):
+    # A few ranges per worker so one slow range doesn't hold up the rest.
+    ranges = split_ranges(length, jobs * 4)
+    by_position = positions is not None
+    bitsdiff = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(count_path_range, a, b, start, stop, by_position)
+            for start, stop in ranges
+        ]
+        for future in futures:
+            range_bitsdiff, range_positions = future.result()
+            bitsdiff += range_bitsdiff
+            add_positions(positions, range_positions)
+    return bitsdiff
+
+
+def count_blocks_parallel(a, b, length, jobs, block_size, positions=None):
+    # Ranges must start on a block boundary so no block is split.
+    ranges = split_ranges(length, jobs * 4, align=math.lcm(CHUNK_SIZE, block_size))
+    by_position = positions is not None
+    counts = array.array("Q")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                count_path_blocks, a, b, start, stop, block_size, by_position
+            )
+            for start, stop in ranges
+        ]
+        for future in futures:
+            range_counts, range_positions = future.result()
+            counts.extend(range_counts)
+            add_positions(positions, range_positions)
+    return counts
+
+
+def count_streams(a_file, b_file, block_size=None, positions=None):
+    # Reads stay CHUNK_SIZE whatever the block size, so memory is bounded.  A
+    # block spanning several reads carries its partial count across them.
+    a_buf = bytearray(CHUNK_SIZE)
+    b_buf = bytearray(CHUNK_SIZE)
+
+    a_len = b_len = 0
+    bitsdiff = 0
+    counts = array.array("Q") if block_size else None
+    block_fill = block_count = 0
+    while True:
+        a_chunk = read_full(a_file, a_buf)
+        b_chunk = read_full(b_file, b_buf)
+        a_len += len(a_chunk)
+        b_len += len(b_chunk)
+        length = min(len(a_chunk), len(b_chunk))
+        if block_size:
+            offset = 0
+            while offset < length:
+                end = min(length, offset + block_size - block_fill)
+                block_count += count_range(a_chunk, b_chunk, offset, end, positions)
+                block_fill += end - offset
+                offset = end
+                if block_fill == block_size:
+                    counts.append(block_count)
+                    block_fill = block_count = 0
+        else:
+            bitsdiff += count_range(a_chunk, b_chunk, 0, length, positions)
+        if length < CHUNK_SIZE:
+            break
+    if block_fill:
+        counts.append(block_count)
+
+    # Only the length of whatever is left over matters.
+    while a_chunk := read_full(a_file, a_buf):
+        a_len += len(a_chunk)
+    while b_chunk := read_full(b_file, b_buf):
+        b_len += len(b_chunk)
+
+    if block_size:
+        bitsdiff = sum(counts)
+    return a_len, b_len, bitsdiff, counts
+
+
+# Smallest step count_pairs takes, so very many inputs don't make the
+# per-step Python overhead dominate.
+PAIRS_MIN_STEP = 1 << 12
+
+
+def count_pairs(maps, pairs, start, stop):
+    # Each input's chunk is converted once and XORed against every partner,
+    # so a reference shared by many pairs is only read once.  Every input
+    # holds a slice and an int per step, so the step shrinks as inputs are
+    # added to keep the total near CHUNK_SIZE.
+    step = max(PAIRS_MIN_STEP, CHUNK_SIZE // len(maps))
+    totals = [0] * len(pairs)
+    for offset in range(start, stop, step):
+        end = min(offset + step, stop)
+        ints = [int.from_bytes(m[offset:end], "little") for m in maps]
+        for idx, (i, j) in enumerate(pairs):
+            pair_end = min(end, len(maps[i]), len(maps[j]))
+            if pair_end <= offset:
+                continue
+            xor = ints[i] ^ ints[j]
+            if pair_end < end:
+                xor &= (1 << (8 * (pair_end - offset))) - 1
+            totals[idx] += xor.bit_count()
+    return totals
+
+
+def count_path_pairs(paths, pairs, start, stop):
+    return count_pairs([open_mapped(path) for path in paths], pairs, start, stop)
+
+
+def count_pairs_parallel(paths, pairs, length, jobs):
+    ranges = split_ranges(length, jobs * 4)
+    totals = [0] * len(pairs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(count_path_pairs, paths, pairs, start, stop)
+            for start, stop in ranges
+        ]
+        for future in futures:
+            for idx, count in enumerate(future.result()):
+                totals[idx] += count
+    return totals
+
+
+def write_histogram(path, counts, block_size):
+    with path.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["offset", "bits_differing"])
+        for idx, count in enumerate(counts):
+            writer.writerow([idx * block_size, count])
+
+
+def find_hotspots(counts, block_size, top):
+    worst = heapq.nlargest(top, range(len(counts)), key=counts.__getitem__)
+    return [(idx * block_size, counts[idx]) for idx in worst if counts[idx]]
+
+
 @click.command()
 @click.argument("a", type=pathlib.Path)
-@click.argument("b", type=pathlib.Path)
-def main(a, b):
-    a_bytes = a.read_bytes()
-    b_bytes = b.read_bytes()
+@click.argument("others", type=pathlib.Path, nargs=-1, required=True)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--block-size",
+    type=click.IntRange(min=1),
+    help="Count differing bits per block of this many bytes.",
+)
+@click.option(
+    "--histogram",
+    type=pathlib.Path,
+    help="Write per-block counts to this CSV file (needs --block-size).",
+)
+@click.option(
+    "--top",
+    type=click.IntRange(min=0),
+    default=10,
+    show_default=True,
+    help="Number of worst blocks to report (needs --block-size).",
+)
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    help="Print the result as JSON, including per-bit-position counts.",
+)
+@click.option(
+    "--all-pairs",
+    is_flag=True,
+    help="Compare every pair of the given files, not just A against the rest.",
+)
+def main(a, others, jobs, block_size, histogram, top, as_json, all_pairs):
+    """Count the bits that differ between A and each other file."""
+    if histogram and not block_size:
+        raise click.UsageError("--histogram requires --block-size")
 
-    bitstotal = 0
-    bitsdiff = 0
+    if len(others) == 1 and not all_pairs:
+        diff_pair(a, others[0], jobs, block_size, histogram, top, as_json)
+        return
+
+    if block_size:
+        raise click.UsageError("--block-size only works with two files")
+    paths = [a, *others]
+    if any(is_stream(path) for path in paths):
+        raise click.UsageError("comparing more than two files needs regular files")
+    if all_pairs:
+        pairs = list(itertools.combinations(range(len(paths)), 2))
+    else:
+        pairs = [(0, j) for j in range(1, len(paths))]
+    diff_batch(paths, pairs, jobs, as_json)
+
+
+def diff_batch(paths, pairs, jobs, as_json):
+    maps = [open_mapped(path) for path in paths]
+    length = max(min(len(maps[i]), len(maps[j])) for i, j in pairs)
+    if jobs > 1:
+        totals = count_pairs_parallel(paths, pairs, length, jobs)
+    else:
+        totals = count_pairs(maps, pairs, 0, length)
+
+    if as_json:
+        results = []
+        for (i, j), bitsdiff in zip(pairs, totals):
+            tail = len(maps[i]) - len(maps[j])
+            results.append({
+                "a": str(paths[i]),
+                "b": str(paths[j]),
+                "bits_compared": min(len(maps[i]), len(maps[j])) * 8,
+                "bits_differing": bitsdiff,
+                "tail_bytes": abs(tail),
+                "tail_in": "a" if tail > 0 else "b" if tail < 0 else None,
+            })
+        print(json.dumps(results))
+        return
+
+    matrix = {}
+    for (i, j), bitsdiff in zip(pairs, totals):
+        bitstotal = min(len(maps[i]), len(maps[j])) * 8
+        percent = bitsdiff / bitstotal * 100 if bitstotal else 0.0
+        matrix[i, j] = matrix[j, i] = f"{percent:.6g}%"
+
+    rows = sorted({i for i, _ in pairs})
+    cols = sorted({j for _, j in pairs})
+    if len(rows) > 1:
+        rows = cols = range(len(paths))
+    for idx, path in enumerate(paths):
+        print(f"[{idx}] {path}")
+    print()
+    width = max(len(cell) for cell in matrix.values())
+    print(" " * 5 + "".join(f" {f'[{j}]':>{width}}" for j in cols))
+    for i in rows:
+        cells = "".join(f" {matrix.get((i, j), '-'):>{width}}" for j in cols)
+        print(f"{f'[{i}]':>5}{cells}")
+
+
+def diff_pair(a, b, jobs, block_size, histogram, top, as_json):
+    if a == b == pathlib.Path("-"):
+        raise click.UsageError("only one input can be read from stdin")
+
+    # Per-bit-position counts cost extra work per chunk, so only the JSON
+    # output, which reports them, pays for it.
+    positions = new_positions(as_json)
+    if is_stream(a) or is_stream(b):
+        # Streams can only be read once, in order, so --jobs doesn't apply.
+        with open_stream(a) as a_file, open_stream(b) as b_file:
+            a_len, b_len, bitsdiff, counts = count_streams(
+                a_file, b_file, block_size, positions
+            )
+    else:
+        a_map = open_mapped(a)
+        b_map = open_mapped(b)
+        a_len = len(a_map)
+        b_len = len(b_map)
+        length = min(a_len, b_len)
+        if block_size:
+            if jobs > 1:
+                counts = count_blocks_parallel(
+                    a, b, length, jobs, block_size, positions
+                )
+            else:
+                counts = count_blocks(a_map, b_map, 0, length, block_size, positions)
+            bitsdiff = sum(counts)
+        elif jobs > 1:
+            bitsdiff = count_parallel(a, b, length, jobs, positions)
+        else:
+            bitsdiff = count_range(a_map, b_map, 0, length, positions)
+
+    tail = a_len - b_len
+    bitstotal = min(a_len, b_len) * 8
+    if block_size:
+        hotspots = find_hotspots(counts, block_size, top)
+        if histogram:
+            write_histogram(histogram, counts, block_size)
+
+    if as_json:
+        result = {
+            "bits_compared": bitstotal,
+            "bits_differing": bitsdiff,
+            "tail_bytes": abs(tail),
+            "tail_in": "a" if tail > 0 else "b" if tail < 0 else None,
+            "bit_position_counts": positions,
+        }
+        if block_size:
+            result["block_size"] = block_size
+            result["hotspots"] = [
+                {"offset": offset, "bits_differing": count}
+                for offset, count in hotspots
+            ]
+        print(json.dumps(result))
+        return
 
-    for a_by, b_by in zip(a_bytes, b_bytes):
-        xor = a_by ^ b_by
-        bitsdiff += xor.bit_count()
-        bitstotal += 8
+    percent = bitsdiff / bitstotal * 100 if bitstotal else 0.0
+    print(f"{bitsdiff}/{bitstotal} bits differ ({percent}%)")
+    if tail:
+        print(f"{abs(tail)} trailing bytes only in {a if tail > 0 else b}")
 
-    print(f"{bitsdiff}/{bitstotal} bits differ ({bitsdiff / bitstotal * 100}%)")
+    if block_size and top:
+        print(f"Worst {block_size}-byte blocks:")
+        for offset, count in hotspots:
+            print(f"  0x{offset:08x}: {count} bits differ")
 
 
 if __name__ == '__main__':
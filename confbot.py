@@ -5,6 +5,7 @@
 # dependencies = [
 #     "async-typer",
 #     "loguru",
+#     "pulsectl",
 #     "pydantic",
 #     "rich",
 #     "rofimoji",
@@ -13,7 +14,6 @@
 # ]
 # ///
 
-import asyncio
 import dataclasses
 import enum
 from collections.abc import Awaitable, Callable, Iterable
@@ -22,35 +22,246 @@ import json
 import os
 import hashlib
 import shutil
+import socket
+import stat
 import struct
 import subprocess
+import sys
+import time
+import types
 from pathlib import Path
-from typing import Annotated, Any
+from typing import TYPE_CHECKING, Annotated, Any
 
-import pydantic
-import typer
-import async_typer
-import web_pdb
-from loguru import logger
+if TYPE_CHECKING:
+    import asyncio
 
+# Startup timings are measured from here.  asyncio and the third-party
+# modules are imported by the commands that need them: `confbot shell` runs on
+# every new terminal and needs none of them.
+START_TIME = time.perf_counter()
 
-app = async_typer.AsyncTyper()
 
+class LazyLogger:
+    """Stands in for loguru's logger, importing loguru on first use."""
 
-RestArgs = Annotated[
-    list[str],
-    typer.Option(default_factory=list, help="Remaining arguments passed to program"),
-]
+    def __getattr__(self, name: str) -> Any:
+        from loguru import logger as loguru_logger
+
+        return getattr(loguru_logger, name)
+
+
+logger = LazyLogger()
+
+
+@dataclasses.dataclass
+class DefaultSinkCache:
+    """Remembers the default sink until invalidate() is called.
+
+    One-shot commands never invalidate it; the daemon does so whenever
+    `pactl subscribe` reports that the default sink may have changed.
+    """
+
+    sink: bytes | None = None
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+    def get(self) -> bytes:
+        if self.sink is not None:
+            self.hits += 1
+            return self.sink
+        self.misses += 1
+        self.sink = subprocess.run(
+            [which("pactl"), "get-default-sink"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.strip()
+        return self.sink
+
+    def invalidate(self) -> None:
+        self.invalidations += 1
+        self.sink = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+default_sink_cache = DefaultSinkCache()
+
+
+def get_default_audio_sink() -> bytes:
+    return default_sink_cache.get()
+
+
+def is_sink_event(line: str) -> bool:
+    """Whether a `pactl subscribe` line may mean a new default sink.
+
+    Sink "change" events are left out: every volume change sends one.
+    """
+    match line.split():
+        case ["Event", "'change'", "on", "server", *_]:
+            return True
+        case ["Event", "'new'" | "'remove'", "on", "sink", *_]:
+            return True
+    return False
+
+
+async def watch_default_sink(cache: DefaultSinkCache, retry_delay: float = 5) -> None:
+    import asyncio
+
+    while True:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                which("pactl"),
+                "subscribe",
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.debug(f"Can't watch for sink changes: {e}")
+            return
+
+        # Anything that happened before the subscription was missed.
+        cache.invalidate()
+        async for line in proc.stdout:
+            if is_sink_event(line.decode()):
+                logger.debug(f"Default sink may have changed: {line=}")
+                cache.invalidate()
+
+        await proc.wait()
+        logger.debug(f"pactl subscribe exited ({proc.returncode}), restarting")
+        await asyncio.sleep(retry_delay)
+
+
+class AudioError(Exception):
+    """Raised when the sound server can't make a change."""
+
+
+def parse_mute(mute: str, current: bool) -> bool:
+    if mute == "toggle":
+        return not current
+    return mute.lower() in {"1", "yes", "true", "on"}
+
+
+def parse_volume(volume: str) -> tuple[bool, float]:
+    """Parse a pactl-style percentage into (is_relative, fraction)."""
+    try:
+        return volume[0] in "+-", float(volume.removesuffix("%")) / 100
+    except (IndexError, ValueError):
+        raise AudioError(f"Unsupported volume: {volume!r}") from None
+
+
+class PactlBackend:
+    """Runs pactl for each change, with mute and volume set concurrently."""
+
+    def apply(self, mute: str | None, volume: str | None) -> None:
+        pactl = which("pactl")
+        sink = get_default_audio_sink()
+        commands = []
+        if mute:
+            commands.append([pactl, "set-sink-mute", sink, mute])
+        if volume:
+            commands.append([pactl, "set-sink-volume", sink, volume])
+
+        procs = [subprocess.Popen(cmd, stdin=subprocess.DEVNULL) for cmd in commands]
+        for proc in procs:
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+class PulseBackend:
+    """Keeps one native protocol connection to the sound server, via pulsectl.
+
+    Works with PulseAudio and pipewire-pulse alike.  The default sink is
+    looked up on that connection too, so DefaultSinkCache is only used by
+    PactlBackend.
+    """
+
+    def __init__(self):
+        import pulsectl
+
+        self.pulsectl = pulsectl
+        self.pulse = None
+
+    def apply(self, mute: str | None, volume: str | None) -> None:
+        try:
+            if not self.pulse:
+                self.pulse = self.pulsectl.Pulse("confbot")
+            # Asked over the same connection, so no pactl is ever forked.
+            sink_name = self.pulse.server_info().default_sink_name
+            sink = self.pulse.get_sink_by_name(sink_name)
+            if mute:
+                self.pulse.mute(sink, parse_mute(mute, sink.mute))
+            if volume:
+                relative, value = parse_volume(volume)
+                if relative:
+                    self.pulse.volume_change_all_chans(sink, value)
+                else:
+                    self.pulse.volume_set_all_chans(sink, value)
+        except (self.pulsectl.PulseError, self.pulsectl.PulseDisconnected) as e:
+            # Likely the server restarted, so reconnect on the next change.
+            self.close()
+            raise AudioError(str(e) or type(e).__name__) from e
+
+    def close(self) -> None:
+        if self.pulse:
+            self.pulse.close()
+            self.pulse = None
+
+
+@dataclasses.dataclass
+class FakeAudioBackend:
+    """A sound server kept in memory, for tests."""
+
+    mute: bool = False
+    volume: float = 1.0
+    changes: list[tuple[str | None, str | None]] = dataclasses.field(
+        default_factory=list
+    )
+
+    def apply(self, mute: str | None, volume: str | None) -> None:
+        self.changes.append((mute, volume))
+        if mute:
+            self.mute = parse_mute(mute, self.mute)
+        if volume:
+            relative, value = parse_volume(volume)
+            self.volume = max(0.0, self.volume + value) if relative else value
+
+
+AUDIO_BACKENDS = {
+    "pulse": PulseBackend,
+    "pactl": PactlBackend,
+    "fake": FakeAudioBackend,
+}
 
 
 @functools.cache
-def get_default_audio_sink():
-    return subprocess.run(
-        [which("pactl"), "get-default-sink"],
+def audio_backend() -> PactlBackend | PulseBackend | FakeAudioBackend:
+    """Use $CONFBOT_AUDIO_BACKEND if set, else pulsectl if it loads, else pactl."""
+    if name := os.environ.get("CONFBOT_AUDIO_BACKEND"):
+        if name not in AUDIO_BACKENDS:
+            raise AudioError(f"Unknown audio backend: {name!r}")
+        return AUDIO_BACKENDS[name]()
+    try:
+        return PulseBackend()
+    except (ImportError, OSError):
+        # pulsectl raises OSError when libpulse itself is missing.
+        return PactlBackend()
+
+
+def spawn_detached(cmd: Iterable[str], *args: str | os.PathLike[str]) -> None:
+    subprocess.Popen(
+        [which(cmd), *args],
+        start_new_session=True,
         stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        check=True,
-    ).stdout.strip()
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
 
 
 @dataclasses.dataclass
@@ -60,33 +271,17 @@ class KeyProps:
     should_whit: bool = False
 
     def handle(self):
-        if self.target_mute_state:
-            subprocess.run(
-                [
-                    "pactl",
-                    "set-sink-mute",
-                    get_default_audio_sink(),
-                    self.target_mute_state,
-                ],
-                check=True,
-            )
-
-        if self.target_volume:
-            subprocess.run(
-                [
-                    "pactl",
-                    "set-sink-volume",
-                    get_default_audio_sink(),
-                    self.target_volume,
-                ],
-                check=True,
-            )
+        if self.target_mute_state or self.target_volume:
+            audio_backend().apply(self.target_mute_state, self.target_volume)
 
         if self.should_whit:
-            run_detach(
-                ["play", "aplay", "mpv"],
-                Path.home() / "dotfiles" / "assets" / "whit.wav",
-            )
+            try:
+                spawn_detached(
+                    ["play", "aplay", "mpv"],
+                    Path.home() / "dotfiles" / "assets" / "whit.wav",
+                )
+            except FileNotFoundError as e:
+                logger.debug(f"Not playing whit: {e}")
 
 
 XF86_KEYS = {
@@ -128,23 +323,31 @@ class SwayMsg(enum.Enum):
     EVENT_INPUT = 0x800000015
 
 
-class SwayCmdResult(pydantic.BaseModel):
-    success: bool
-    parse_error: bool = False
-    error: str = ""
-
-
-class SwayBindingInfo(pydantic.BaseModel):
-    command: str
-    event_state_mask: list[str]
-    input_code: int
-    input_type: str
-    symbol: str | None = None
-
-
-class SwayEventBinding(pydantic.BaseModel):
-    change: str
-    binding: SwayBindingInfo
+@functools.cache
+def sway_models() -> types.SimpleNamespace:
+    import pydantic
+
+    class SwayCmdResult(pydantic.BaseModel):
+        success: bool
+        parse_error: bool = False
+        error: str = ""
+
+    class SwayBindingInfo(pydantic.BaseModel):
+        command: str
+        event_state_mask: list[str]
+        input_code: int
+        input_type: str
+        symbol: str | None = None
+
+    class SwayEventBinding(pydantic.BaseModel):
+        change: str
+        binding: SwayBindingInfo
+
+    return types.SimpleNamespace(
+        SwayCmdResult=SwayCmdResult,
+        SwayBindingInfo=SwayBindingInfo,
+        SwayEventBinding=SwayEventBinding,
+    )
 
 
 @dataclasses.dataclass
@@ -152,15 +355,16 @@ class SwayIPCError(Exception):
     """Raised for errors reported by sway during IPC."""
 
     message: str
-    cmd_results: list[SwayCmdResult] | None = None
+    # sway_models().SwayCmdResult, which only exists once pydantic is loaded.
+    cmd_results: list[Any] | None = None
 
 
 @dataclasses.dataclass
 class SwayIPC:
-    reader: asyncio.StreamReader
-    writer: asyncio.StreamWriter
+    reader: "asyncio.StreamReader"
+    writer: "asyncio.StreamWriter"
     _subscribed: set[SwayMsg] = dataclasses.field(default_factory=set)
-    _queues: list[asyncio.Queue] = dataclasses.field(default_factory=list)
+    _queues: list["asyncio.Queue"] = dataclasses.field(default_factory=list)
     _shutdown: bool = False
 
     async def write_message(self, message_type: SwayMsg, payload: bytes) -> None:
@@ -181,6 +385,8 @@ class SwayIPC:
         return message_type, payload_json
 
     async def wait_for_message(self) -> tuple[SwayMsg, Any]:
+        import asyncio
+
         logger.debug("Waiting for message...")
         queue = asyncio.Queue()
         self._queues.append(queue)
@@ -217,7 +423,7 @@ class SwayIPC:
     async def run_command(self, command: str) -> None:
         await self.write_message(SwayMsg.RUN_COMMAND, command.encode("utf-8"))
         response = await self.wait_for_message_of_type(SwayMsg.RUN_COMMAND)
-        cmd_results = [SwayCmdResult.model_validate(x) for x in response]
+        cmd_results = [sway_models().SwayCmdResult.model_validate(x) for x in response]
         if any(not x.success for x in cmd_results):
             raise SwayIPCError(
                 f"Error running command: {command}", cmd_results=cmd_results
@@ -256,14 +462,6 @@ class SwayIPC:
                     cb()
 
 
-def hash_file(path: Path) -> str:
-    hasher = hashlib.sha256()
-    with path.open("rb") as f:
-        while chunk := f.read(8192):
-            hasher.update(chunk)
-    return hasher.hexdigest()
-
-
 def which(cmd: Iterable[str]) -> Path:
     if isinstance(cmd, str):
         cmd = (cmd,)
@@ -288,13 +486,80 @@ def which_setdefault(dct: dict[Any, str], key: Any, search: Iterable[str]) -> st
     return str(path)
 
 
-@app.callback()
-def ensure_env() -> None:
-    confbot_marker = hash_file(Path(__file__))
+ENV_CACHE_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "confbot"
+    / "env.json"
+)
+
+# Everything setup_env() reads from the environment; a change to any of these
+# needs a fresh snapshot.
+ENV_INPUTS = ("PATH", "BROWSER", "XTERM", "EDITOR", "PAGER", "TERM")
+ENV_CACHE_ENTRIES = 16
+
+
+def script_marker() -> str:
+    stat = Path(__file__).stat()
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def load_env_snapshots() -> dict[str, dict[str, str]]:
+    try:
+        return json.loads(ENV_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_env_snapshots(snapshots: dict[str, dict[str, str]]) -> None:
+    try:
+        ENV_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = ENV_CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(snapshots))
+        tmp_path.replace(ENV_CACHE_PATH)
+    except OSError as e:
+        logger.debug(f"Unable to save environment snapshot: {e}")
+
+
+def ensure_env(timings: bool = False) -> None:
+    env_start = time.perf_counter()
+    confbot_marker = script_marker()
 
     if os.environ.get("CONFBOT_MARKER") == confbot_marker:
-        return
+        source = "inherited"
+    else:
+        # The outcome of setup_env() only depends on this script and the
+        # inputs above, so replay it from a snapshot when possible instead of
+        # probing PATH again.
+        key = hashlib.sha256(
+            json.dumps(
+                [confbot_marker, *(os.environ.get(x) for x in ENV_INPUTS)]
+            ).encode()
+        ).hexdigest()
+        snapshots = load_env_snapshots()
+        if snapshot := snapshots.get(key):
+            os.environ.update(snapshot)
+            source = "cached"
+        else:
+            before = dict(os.environ)
+            setup_env(confbot_marker)
+            snapshots[key] = {
+                k: v for k, v in os.environ.items() if before.get(k) != v
+            }
+            while len(snapshots) > ENV_CACHE_ENTRIES:
+                del snapshots[next(iter(snapshots))]
+            save_env_snapshots(snapshots)
+            source = "computed"
+
+    if timings:
+        env_end = time.perf_counter()
+        print(
+            f"imports: {(env_start - START_TIME) * 1000:.1f}ms, "
+            f"environment ({source}): {(env_end - env_start) * 1000:.1f}ms",
+            file=sys.stderr,
+        )
 
+
+def setup_env(confbot_marker: str) -> None:
     path = os.environ.get("PATH", os.defpath)
     path_parts = [Path(x) for x in path.split(os.pathsep)]
     path_parts = [
@@ -331,6 +596,8 @@ def ensure_env() -> None:
 
 
 async def run_detach(cmd: str | os.PathLike[str], *args: str | os.PathLike[str]):
+    import asyncio
+
     cmd_path = which(cmd)
     await asyncio.create_subprocess_exec(
         cmd_path,
@@ -342,19 +609,128 @@ async def run_detach(cmd: str | os.PathLike[str], *args: str | os.PathLike[str])
     )
 
 
-@app.command()
-def handle_xf86_key(key: Annotated[KeyProps, typer.Argument(parser=XF86_KEYS.get)]):
-    key.handle()
+DAEMON_SOCKET = (
+    Path(os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/confbot-{os.getuid()}")
+    / "confbot.sock"
+)
+# Generous, as keys queue up behind each other in the daemon.  Past this an
+# error is reported; the key isn't retried, as the daemon may still apply it.
+DAEMON_TIMEOUT = 5.0
+
+
+def handle_key_name(key_name: str) -> str:
+    if not (key := XF86_KEYS.get(key_name)):
+        return f"error unknown key {key_name!r}"
+    try:
+        key.handle()
+    except (OSError, subprocess.CalledProcessError, AudioError) as e:
+        return f"error {e}"
+    return "ok"
+
+
+def send_to_daemon(request: str) -> str | None:
+    """Send a running daemon one request.
+
+    Returns None only if no daemon could be reached, so it's safe to handle
+    the request in-process instead.  Once it has been sent, failures are
+    reported as an "error ..." reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(DAEMON_TIMEOUT)
+        try:
+            sock.connect(str(DAEMON_SOCKET))
+        except (FileNotFoundError, ConnectionRefusedError, PermissionError, TimeoutError):
+            return None
+        try:
+            sock.sendall(f"{request}\n".encode())
+            with sock.makefile("r") as f:
+                return f.readline().strip() or "error daemon closed the connection"
+        except TimeoutError:
+            return "error no reply from daemon"
+        except OSError as e:
+            return f"error daemon connection failed: {e}"
+
+
+def sink_cache_stats() -> str:
+    if not isinstance(backend := audio_backend(), PactlBackend):
+        return f"error {type(backend).__name__} doesn't cache the default sink"
+    return f"ok {json.dumps(default_sink_cache.stats())}"
+
+
+async def serve_daemon_client(
+    key_lock: "asyncio.Lock",
+    reader: "asyncio.StreamReader",
+    writer: "asyncio.StreamWriter",
+) -> None:
+    import asyncio
+
+    # One key name per line, answered with "ok" or "error <reason>".  Keys
+    # are handled in a thread, so the event loop stays free for other
+    # clients and the sink watcher, but one at a time under key_lock so
+    # volume steps apply in order.  "stats" is answered with "ok" and the
+    # default sink cache counters as JSON, when the backend uses that cache.
+    try:
+        async for line in reader:
+            if (request := line.decode().strip()) == "stats":
+                response = sink_cache_stats()
+            else:
+                async with key_lock:
+                    response = await asyncio.to_thread(handle_key_name, request)
+            logger.debug(f"Daemon handled {line=}: {response}")
+            writer.write(f"{response}\n".encode())
+            await writer.drain()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def check_daemon_dir(path: Path) -> None:
+    """Create the socket directory, refusing one someone else could control.
+
+    Without $XDG_RUNTIME_DIR it lives in /tmp, where another user could
+    create it first.
+    """
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = path.lstat()
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"{path} is not a directory")
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {st.st_uid}")
+    if st.st_mode & 0o077:
+        raise PermissionError(
+            f"{path} is accessible by other users (mode {stat.S_IMODE(st.st_mode):o})"
+        )
+
 
+async def run_daemon() -> None:
+    import asyncio
+
+    check_daemon_dir(DAEMON_SOCKET.parent)
+    # Picked up front, as only PactlBackend relies on the default sink cache
+    # (and so on the watcher); PulseBackend asks over its own connection.
+    backend = audio_backend()
+    DAEMON_SOCKET.unlink(missing_ok=True)
+    server = await asyncio.start_unix_server(
+        functools.partial(serve_daemon_client, asyncio.Lock()), path=DAEMON_SOCKET
+    )
+    DAEMON_SOCKET.chmod(0o600)
+    logger.debug(f"Listening on {DAEMON_SOCKET}")
+    async with server, asyncio.TaskGroup() as tg:
+        if isinstance(backend, PactlBackend):
+            tg.create_task(watch_default_sink(default_sink_cache))
+        await server.serve_forever()
 
-@app.command()
-def shell(args: RestArgs):
+
+def run_shell(args: list[str]) -> None:
     zsh = which("zsh")
     os.execvpe(zsh, [zsh, *args], os.environ)
 
 
-@app.async_command()
-async def swaymon():
+async def run_swaymon() -> None:
+    import asyncio
+
+    import web_pdb
+
     with web_pdb.catch_post_mortem():
         swayipc_path = os.environ["SWAYSOCK"]
         reader, writer = await asyncio.open_unix_connection(swayipc_path)
@@ -369,5 +745,83 @@ async def swaymon():
             )
 
 
+def build_app() -> Any:
+    import async_typer
+    import typer
+
+    app = async_typer.AsyncTyper()
+
+    RestArgs = Annotated[
+        list[str],
+        typer.Option(
+            default_factory=list, help="Remaining arguments passed to program"
+        ),
+    ]
+
+    @app.callback()
+    def callback(
+        timings: Annotated[
+            bool, typer.Option(help="Report startup timings on stderr")
+        ] = False,
+    ) -> None:
+        ensure_env(timings)
+
+    @app.command()
+    def handle_xf86_key(key_name: str):
+        if (response := send_to_daemon(key_name)) is None:
+            response = handle_key_name(key_name)
+        if response != "ok":
+            raise typer.BadParameter(response.removeprefix("error "))
+
+    @app.async_command()
+    async def daemon():
+        """Handle XF86 keys in a resident process, listening on a Unix socket.
+
+        Bind keys to a client that doesn't start Python at all, e.g.:
+
+            echo XF86AudioMute | socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/confbot.sock
+        """
+        try:
+            await run_daemon()
+        except (PermissionError, AudioError) as e:
+            typer.echo(f"Refusing to start: {e}", err=True)
+            raise typer.Exit(1)
+
+    @app.command()
+    def daemon_stats():
+        """Print the running daemon's default sink cache counters (pactl only)."""
+        if (response := send_to_daemon("stats")) is None:
+            typer.echo("No daemon is running", err=True)
+            raise typer.Exit(1)
+        if not response.startswith("ok "):
+            typer.echo(response.removeprefix("error "), err=True)
+            raise typer.Exit(1)
+        typer.echo(response.removeprefix("ok "))
+
+    @app.command()
+    def shell(args: RestArgs):
+        run_shell(args)
+
+    @app.async_command()
+    async def swaymon():
+        await run_swaymon()
+
+    return app
+
+
+def main() -> None:
+    # The plain form of `confbot shell` is handled without building the typer
+    # app, as typer alone costs more than everything else shell needs.
+    match sys.argv[1:]:
+        case ["shell"]:
+            ensure_env()
+            run_shell([])
+        case ["--timings", "shell"]:
+            ensure_env(timings=True)
+            run_shell([])
+        case _:
+            build_app()()
+
+
 if __name__ == "__main__":
-    app()
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""Time cold starts of `confbot shell`, failing if they exceed a budget"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+CONFBOT = Path(__file__).resolve().parent / "confbot.py"
+
+
+def fake_env(root):
+    # A zsh that exits immediately, and a home and cache nobody else touches,
+    # so each run starts from scratch like a new terminal with no cache.
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "zsh").symlink_to("/bin/true")
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in {"CONFBOT_MARKER", "XDG_CACHE_HOME"}
+    }
+    env["HOME"] = str(root)
+    env["PATH"] = f"{bin_dir}{os.pathsep}{env.get('PATH', '')}"
+    return env
+
+
+def time_runs(argv, env, runs, cache_dir=None):
+    times = []
+    for _ in range(runs):
+        if cache_dir:
+            for path in cache_dir.glob("**/*.json"):
+                path.unlink()
+        start = time.perf_counter()
+        subprocess.run(argv, env=env, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n", "--runs", type=int, default=20, help="Cold starts to time"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=150,
+        help="Maximum median wall time for `confbot shell`, in milliseconds",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        env = fake_env(root)
+        results = [
+            ("python -c pass", time_runs([sys.executable, "-c", "pass"], env, args.runs)),
+            (
+                "confbot shell (cached)",
+                time_runs([sys.executable, CONFBOT, "shell"], env, args.runs),
+            ),
+            (
+                "confbot shell (uncached)",
+                time_runs(
+                    [sys.executable, CONFBOT, "shell"],
+                    env,
+                    args.runs,
+                    cache_dir=root / ".cache",
+                ),
+            ),
+        ]
+
+    print(f"{'command':<26} {'median ms':>10} {'min ms':>8}")
+    for name, times in results:
+        print(f"{name:<26} {statistics.median(times):>10.1f} {min(times):>8.1f}")
+
+    worst = max(statistics.median(times) for _, times in results[1:])
+    if worst > args.budget:
+        print(
+            f"confbot shell took {worst:.1f}ms, over the {args.budget:.0f}ms budget",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,83 @@
+import argparse
+import array
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import pathlib
 import subprocess
 import sys
 import string
+import tempfile
 import unicodedata
 
-result = subprocess.run(
-    ['gcc', '-dM', '-E', '/usr/include/linux/input-event-codes.h'],
-    check=True,
-    stdout=subprocess.PIPE,
-    encoding='utf-8',
+INPUT_EVENT_CODES = pathlib.Path('/usr/include/linux/input-event-codes.h')
+CACHE_PATH = pathlib.Path(
+    os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache',
+    'fmtmap',
+    'input-event-codes.json',
 )
 
-name_to_keycodes = {}
-for line in result.stdout.splitlines():
-    if line.startswith('#define KEY_'):
-        words = line.split()
-        if len(words) != 3:
-            continue
-        try:
-            keycode = int(words[2], base=0)
-        except ValueError:
-            continue
-        name_to_keycodes[words[1]] = keycode
+
+def parse_keycodes(header):
+    result = subprocess.run(
+        ['gcc', '-dM', '-E', str(header)],
+        check=True,
+        stdout=subprocess.PIPE,
+        encoding='utf-8',
+    )
+
+    name_to_keycodes = {}
+    for line in result.stdout.splitlines():
+        if line.startswith('#define KEY_'):
+            words = line.split()
+            if len(words) != 3:
+                continue
+            try:
+                keycode = int(words[2], base=0)
+            except ValueError:
+                continue
+            name_to_keycodes[words[1]] = keycode
+    return name_to_keycodes
+
+
+def load_keycodes(header=INPUT_EVENT_CODES, cache_path=CACHE_PATH):
+    # Running gcc dominates startup, so keep its result keyed by the header's
+    # path.  An unchanged mtime is trusted as-is; otherwise the content hash
+    # decides whether gcc needs to run again.
+    header = header.resolve()
+    header_stat = header.stat()
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(str(header))
+    if entry and entry['mtime_ns'] == header_stat.st_mtime_ns:
+        return entry['keycodes']
+
+    digest = hashlib.sha256(header.read_bytes()).hexdigest()
+    if entry and entry['sha256'] == digest:
+        keycodes = entry['keycodes']
+    else:
+        keycodes = parse_keycodes(header)
+
+    cache[str(header)] = {
+        'mtime_ns': header_stat.st_mtime_ns,
+        'sha256': digest,
+        'keycodes': keycodes,
+    }
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                'w', dir=cache_path.parent, delete=False) as f:
+            json.dump(cache, f)
+        os.replace(f.name, cache_path)
+    except OSError:
+        # A read-only cache only costs us speed.
+        pass
+    return keycodes
 
 
 rows = [
@@ -153,8 +210,62 @@ def modlist(idx):
     return mods
 
 
-prelude = []
-key_defs = {}
+def is_emitted(mods):
+    # Combinations we never write out: too many modifiers, the sided shifts,
+    # and a few that don't make sense in 3L.
+    return (
+        len(mods) < 4
+        and 'shiftr' not in mods
+        and 'shiftl' not in mods
+        and mods not in FORBIDDEN_MODS
+    )
+
+
+def mod_prefix(mods):
+    shift = 'shift' if 'shift' in mods else '     '
+    altgr = 'altgr' if 'altgr' in mods else '     '
+    control = 'control' if 'control' in mods else '       '
+    alt = 'alt' if 'alt' in mods else '   '
+    ctrll = 'ctrll' if 'ctrll' in mods else '     '
+    return f"{ctrll} {alt} {control} {altgr} {shift}"
+
+
+FORBIDDEN_MODS = {
+    frozenset({"ctrll", "shift"}),
+    frozenset({"control", "altgr"}),
+    frozenset({"control", "altgr", "shift"}),
+    frozenset({"alt", "control", "altgr"}),
+    frozenset({"ctrll", "control", "altgr"}),
+}
+
+# Everything print_key needs to know about a modifier index, computed once.
+MOD_COMBOS = [tuple(modlist(idx)) for idx in range(128)]
+MOD_SETS = [frozenset(mods) for mods in MOD_COMBOS]
+MOD_EMITTED = [is_emitted(mods) for mods in MOD_SETS]
+MOD_PREFIXES = [mod_prefix(mods) for mods in MOD_SETS]
+
+
+# Keysyms are interned to small integer IDs so that each key definition is a
+# compact array('I') of 128 IDs rather than a list of 128 strings.
+keysym_names = []
+keysym_ids = {}
+
+
+def keysym_id(name):
+    try:
+        return keysym_ids[name]
+    except KeyError:
+        keysym_ids[name] = len(keysym_names)
+        keysym_names.append(name)
+        return keysym_ids[name]
+
+
+def keysym_row(name):
+    return array.array('I', [keysym_id(name)]) * 128
+
+
+EMPTY_SYMBOLS = frozenset(keysym_id(name) for name in ('VoidSymbol', 'nul', 'Meta_nul'))
+
 keytrans_defs = {
     "U+{:04x}".format(ord(letter)): name
     for letter, name in (
@@ -207,47 +318,55 @@ keytrans_defs = {
 for letter in string.ascii_letters:
     keytrans_defs["U+{:04x}".format(ord(letter))] = letter
 
+# keytrans and unicode_data see the same few hundred keysyms over and over;
+# their cache_info() is reported by --stats.
+LOOKUP_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)
 def keytrans(keysym):
     # don't care about caps state
     if keysym.startswith("+"):
         keysym = keysym[1:]
     return keytrans_defs.get(keysym, keysym)
 
-for line in sys.stdin:
-    line, _, _ = line.partition('#')
-    line_parts = line.split()
-    if not line_parts:
-        continue
-    if line_parts[0] in mod_values:
-        modval = 0
-        while line_parts[0] in mod_values:
-            modval += mod_values[line_parts[0]]
-            line_parts = line_parts[1:]
-        assert line_parts[0] == "keycode"
+
+def parse_keymap(stream):
+    prelude = []
+    key_defs = {}
+    for line in stream:
+        line, _, _ = line.partition('#')
+        line_parts = line.split()
+        if not line_parts:
+            continue
+        if line_parts[0] in mod_values:
+            modval = 0
+            while line_parts[0] in mod_values:
+                modval += mod_values[line_parts[0]]
+                line_parts = line_parts[1:]
+            assert line_parts[0] == "keycode"
+            keycode = int(line_parts[1])
+            assert line_parts[2] == "="
+            line_parts = line_parts[3:]
+            assert len(line_parts) == 1
+            keysym = line_parts[0]
+            if keycode in key_defs:
+                columns = key_defs[keycode]
+            else:
+                columns = keysym_row('VoidSymbol')
+            columns[modval] = keysym_id(keytrans(keysym))
+            key_defs[keycode] = columns
+            continue
+        if line_parts[0] != "keycode":
+            prelude.append(' '.join(line_parts))
+            continue
         keycode = int(line_parts[1])
-        assert line_parts[2] == "="
-        line_parts = line_parts[3:]
-        assert len(line_parts) == 1
-        keysym = line_parts[0]
-        if keycode in key_defs:
-            columns = key_defs[keycode]
-        else:
-            columns = ["VoidSymbol" for _ in range(128)]
-        columns[modval] = keytrans(keysym)
-        key_defs[keycode] = columns
-        continue
-    if line_parts[0] != "keycode":
-        prelude.append(' '.join(line_parts))
-        continue
-    keycode = int(line_parts[1])
-    assert line_parts[2] == '='
-    key_defs[keycode] = [keytrans(keysym) for keysym in line_parts[3:]]
-
-
-key_defs[name_to_keycodes["KEY_SLASH"]] = ["CtrlL"] * 128
-key_defs[name_to_keycodes["KEY_BACKSPACE"]] = ["BackSpace"] * 128
-key_defs[name_to_keycodes["KEY_TAB"]] = ["Escape"] * 128
-key_defs[name_to_keycodes["KEY_LEFTMETA"]] = key_defs[name_to_keycodes["KEY_CAPSLOCK"]]
+        assert line_parts[2] == '='
+        key_defs[keycode] = array.array(
+            'I', [keysym_id(keytrans(keysym)) for keysym in line_parts[3:]])
+    return prelude, key_defs
+
+
 curnum_defs = {
     # Cursor control
     "KEY_Q": "PageUp",
@@ -281,54 +400,66 @@ curnum_defs = {
     "KEY_V": "plus",
     "KEY_B": "comma",
 }
-for keyname, keyval in curnum_defs.items():
-    key_defs[name_to_keycodes[keyname]][mod_values["ctrll"]] = keyval
-    key_defs[name_to_keycodes[keyname]][mod_values["ctrll"] + mod_values["alt"]] = f"Meta_{keyval}"
 
 
-#for keydef in key_defs.values():
-#    symlayer_symbol = keydef[mod_values["altgr"]]
-#    if symlayer_symbol.lower() == symlayer_symbol:
-#        keydef[mod_values["altgr"] + mod_values["control"]] = f"Control_{symlayer_symbol}"
-#        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["shift"]] = f"Control_{symlayer_symbol}"
-#        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["alt"]] = f"Meta_Control_{symlayer_symbol}"
-#        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["alt"] + mod_values["shift"]] = f"Meta_Control_{symlayer_symbol}"
+def apply_layer_overrides(key_defs, name_to_keycodes, curnum_defs=curnum_defs):
+    # Work on copies so one parsed keymap can be reused for many variants.
+    key_defs = {keycode: array.array('I', columns) for keycode, columns in key_defs.items()}
 
+    key_defs[name_to_keycodes["KEY_SLASH"]] = keysym_row("CtrlL")
+    key_defs[name_to_keycodes["KEY_BACKSPACE"]] = keysym_row("BackSpace")
+    key_defs[name_to_keycodes["KEY_TAB"]] = keysym_row("Escape")
+    key_defs[name_to_keycodes["KEY_LEFTMETA"]] = key_defs[name_to_keycodes["KEY_CAPSLOCK"]]
+    for keyname, keyval in curnum_defs.items():
+        key_defs[name_to_keycodes[keyname]][mod_values["ctrll"]] = keysym_id(keyval)
+        key_defs[name_to_keycodes[keyname]][mod_values["ctrll"] + mod_values["alt"]] = keysym_id(f"Meta_{keyval}")
 
-for i in range(0, 10):
-    keyname = f"KEY_{i}"
-    keydef = key_defs[name_to_keycodes[keyname]]
-    for i in range(1, 128):
-        keydef[i] = keydef[0]
+    #for keydef in key_defs.values():
+    #    symlayer_symbol = keydef[mod_values["altgr"]]
+    #    if symlayer_symbol.lower() == symlayer_symbol:
+    #        keydef[mod_values["altgr"] + mod_values["control"]] = f"Control_{symlayer_symbol}"
+    #        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["shift"]] = f"Control_{symlayer_symbol}"
+    #        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["alt"]] = f"Meta_Control_{symlayer_symbol}"
+    #        keydef[mod_values["altgr"] + mod_values["control"] + mod_values["alt"] + mod_values["shift"]] = f"Meta_Control_{symlayer_symbol}"
 
+    for i in range(0, 10):
+        keyname = f"KEY_{i}"
+        keydef = key_defs[name_to_keycodes[keyname]]
+        for i in range(1, 128):
+            keydef[i] = keydef[0]
 
-def hdr(text):
-    print("#==========================================================================")
-    print("#", text)
-    print("#==========================================================================")
-    print()
+    return key_defs
+
+
+def hdr(out, text):
+    out.append("#==========================================================================")
+    out.append(f"# {text}")
+    out.append("#==========================================================================")
+    out.append("")
 
 
 def get_single_symbol_map(keysym):
+    # The modifier index is itself a bitset of mod_values.
+    keysym = keysym_names[keysym]
     if keysym in string.ascii_letters:
-        symbols = []
+        symbols = array.array('I')
         for i in range(128):
-            mods = modlist(i)
-            if 'control' in mods and 'alt' in mods:
-                symbols.append(f"Meta_Control_{keysym.lower()}")
+            if i & mod_values['control'] and i & mod_values['alt']:
+                symbols.append(keysym_id(f"Meta_Control_{keysym.lower()}"))
                 continue
-            if 'control' in mods:
-                symbols.append(f"Control_{keysym.lower()}")
+            if i & mod_values['control']:
+                symbols.append(keysym_id(f"Control_{keysym.lower()}"))
                 continue
-            newsym = keysym.swapcase() if "shift" in mods else keysym
-            if "alt" in mods:
-                symbols.append(f"Meta_{newsym}")
+            newsym = keysym.swapcase() if i & mod_values['shift'] else keysym
+            if i & mod_values['alt']:
+                symbols.append(keysym_id(f"Meta_{newsym}"))
                 continue
-            symbols.append(newsym)
+            symbols.append(keysym_id(newsym))
         return symbols
-    return [keysym] * 128
+    return keysym_row(keysym)
 
 
+@functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)
 def unicode_data(keysym):
     if not keysym.startswith('U+'):
         return ''
@@ -336,67 +467,240 @@ def unicode_data(keysym):
     return f'# {as_str} ({unicodedata.name(as_str)})'
 
 
-def print_keycode_line(keycode, keysym, mods=()):
-    mods_expn = ' '.join(mods)
-    shift = 'shift' if 'shift' in mods else '     '
-    altgr = 'altgr' if 'altgr' in mods else '     '
-    control = 'control' if 'control' in mods else '       '
-    alt = 'alt' if 'alt' in mods else '   '
-    ctrll = 'ctrll' if 'ctrll' in mods else '     '
+def print_keycode_line(out, keycode, keysym, mod_idx=0):
     udata = unicode_data(keysym)
     if 'GREEK' in udata:
         return
-    print(f"{ctrll} {alt} {control} {altgr} {shift} keycode {keycode:>3} = {keysym:10} {udata}".rstrip())
+    out.append(f"{MOD_PREFIXES[mod_idx]} keycode {keycode:>3} = {keysym:10} {udata}".rstrip())
 
 
-def print_key(keycode, key_def):
+def print_key(out, keycode, key_def):
+    # Fill in a copy so that emitting leaves the caller's key_defs intact.
+    key_def = array.array('I', key_def)
     implicit_map = get_single_symbol_map(key_def[0])
     for i in range(0, 128):
-        if key_def[i] in ('VoidSymbol', 'nul', 'Meta_nul'):
+        if key_def[i] in EMPTY_SYMBOLS:
             key_def[i] = implicit_map[i]
-    print_keycode_line(keycode, key_def[0])
+    print_keycode_line(out, keycode, keysym_names[key_def[0]])
     while implicit_map != key_def:
         for mod_idx in range(1, 128):
             need_symb = key_def[mod_idx]
             if need_symb == implicit_map[mod_idx]:
                 continue
-            mods = modlist(mod_idx)
-            if (
-                    len(mods) < 4
-                    and 'shiftr' not in mods
-                    and 'shiftl' not in mods
-                    and set(mods) != {"ctrll", "shift"}
-                    and set(mods) != {"control", "altgr"}
-                    and set(mods) != {"control", "altgr", "shift"}
-                    and set(mods) != {"alt", "control", "altgr"}
-                    and set(mods) != {"ctrll", "control", "altgr"}
-            ):
-                print_keycode_line(keycode, need_symb, mods=mods)
+            if MOD_EMITTED[mod_idx]:
+                print_keycode_line(out, keycode, keysym_names[need_symb], mod_idx)
             implicit_map[mod_idx] = need_symb
 
 
-print("# 3L Keyboard Layout")
-print("# ==================")
-print("# 3L is a derivative of the Neo keyboard layout, designed for typing")
-print("# English text.  For more information, visit:")
-print("# https://github.com/jackrosenthal/threelayout")
-print("#")
-print("# In this implementation, the Sym layer (Mod3 in Neo) is implemented under")
-print("# AltGr, and the Cur layer (Mod4 in Neo) is implemented under CtrlL.")
-print()
-
-
-prelude.append('include "linux-keys-bare"')
-hdr("Prelude")
-for line in prelude:
-    print(line)
-print()
-
+def key_digest(keycode, key_def):
+    hasher = hashlib.sha256(str(keycode).encode())
+    for keysym in key_def:
+        hasher.update(keysym_names[keysym].encode())
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+@functools.cache
+def script_digest():
+    # Emitted blocks depend on this file's tables too, so any edit to it
+    # invalidates cached blocks.
+    return hashlib.sha256(pathlib.Path(__file__).read_bytes()).hexdigest()
+
+
+def load_block_cache(path):
+    try:
+        sidecar = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+    if sidecar.get('version') != script_digest():
+        return {}
+    return sidecar['blocks']
+
+
+def save_block_cache(path, block_cache):
+    path.write_text(json.dumps({'version': script_digest(), 'blocks': block_cache}))
+
+
+def emit(prelude, key_defs, name_to_keycodes, block_cache=None):
+    # Lines are collected and joined once; the caller writes the result in a
+    # single call rather than one write per line.
+    #
+    # With a block_cache (key digest -> emitted lines), only keys whose
+    # definition changed go through print_key.  Afterwards the cache holds
+    # exactly the blocks of this keymap, ready to be saved for the next run.
+    used_blocks = {}
+    out = [
+        "# 3L Keyboard Layout",
+        "# ==================",
+        "# 3L is a derivative of the Neo keyboard layout, designed for typing",
+        "# English text.  For more information, visit:",
+        "# https://github.com/jackrosenthal/threelayout",
+        "#",
+        "# In this implementation, the Sym layer (Mod3 in Neo) is implemented under",
+        "# AltGr, and the Cur layer (Mod4 in Neo) is implemented under CtrlL.",
+        "",
+    ]
+
+    hdr(out, "Prelude")
+    out.extend(prelude)
+    out.append('include "linux-keys-bare"')
+    out.append("")
+
+    for row_name, row_key_names in rows:
+        hdr(out, row_name)
+        for key_name in row_key_names:
+            out.append("# {}".format(key_name))
+            keycode = name_to_keycodes[key_name]
+            if block_cache is None:
+                print_key(out, keycode, key_defs[keycode])
+            else:
+                digest = key_digest(keycode, key_defs[keycode])
+                block = block_cache.get(digest)
+                if block is None:
+                    block = []
+                    print_key(block, keycode, key_defs[keycode])
+                used_blocks[digest] = block
+                out.extend(block)
+            out.append("")
+
+    if block_cache is not None:
+        block_cache.clear()
+        block_cache.update(used_blocks)
+    out.append("")
+    return "\n".join(out)
+
+
+# Per-process state for batch workers, filled in by init_batch_worker.
+batch_state = {}
+
+
+def init_batch_worker(name_to_keycodes, keymaps, names):
+    # The parsed keymaps hold keysym IDs, so the worker must use the same
+    # interning table as the process that parsed them.
+    keysym_names[:] = names
+    keysym_ids.clear()
+    keysym_ids.update((name, idx) for idx, name in enumerate(names))
+    batch_state['name_to_keycodes'] = name_to_keycodes
+    batch_state['keymaps'] = keymaps
+
+
+def build_variant(keymap_name, overrides, output):
+    name_to_keycodes = batch_state['name_to_keycodes']
+    prelude, key_defs = batch_state['keymaps'][keymap_name]
+    key_defs = apply_layer_overrides(
+        key_defs, name_to_keycodes, {**curnum_defs, **overrides})
+    output.write_text(emit(prelude, key_defs, name_to_keycodes))
+    return output
+
+
+def run_batch(manifest_path, output_dir=None, jobs=None):
+    # The manifest names the base keymaps and the curnum_defs override sets:
+    #   {"keymaps": {"us": "us.map"}, "overrides": {"default": {}}}
+    # Every keymap is built with every override set, into
+    # <output_dir>/<keymap>-<override>.map.
+    manifest = json.loads(manifest_path.read_text())
+    base_dir = manifest_path.parent
+    if output_dir is None:
+        output_dir = base_dir / manifest.get('output_dir', '.')
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    name_to_keycodes = load_keycodes()
+    keymaps = {}
+    for keymap_name, path in manifest['keymaps'].items():
+        with open(base_dir / path) as f:
+            keymaps[keymap_name] = parse_keymap(f)
+    override_sets = manifest.get('overrides') or {'default': {}}
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_batch_worker,
+            initargs=(name_to_keycodes, keymaps, keysym_names),
+    ) as executor:
+        futures = [
+            executor.submit(
+                build_variant,
+                keymap_name,
+                overrides,
+                output_dir / f"{keymap_name}-{override_name}.map",
+            )
+            for keymap_name in keymaps
+            for override_name, overrides in override_sets.items()
+        ]
+        return [future.result() for future in futures]
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a 3L console keymap from a keymap on stdin.")
+    parser.add_argument(
+        "--batch",
+        type=pathlib.Path,
+        metavar="MANIFEST",
+        help="Build every keymap/override combination listed in a JSON manifest",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=positive_int, help="Number of batch worker processes")
+    parser.add_argument(
+        "--output-dir", type=pathlib.Path, help="Directory for batch outputs")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        help="Write the keymap to this file instead of stdout",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=pathlib.Path,
+        metavar="SIDECAR",
+        help="Reuse emitted blocks of unchanged keys, cached in this file",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print lookup cache hit/miss counts to stderr (not with --batch)",
+    )
+    args = parser.parse_args()
+
+    if args.batch:
+        for option, value in (
+            ("-o/--output", args.output),
+            ("--incremental", args.incremental),
+            ("--stats", args.stats),
+        ):
+            if value:
+                parser.error(f"{option} does not work with --batch")
+        run_batch(args.batch, args.output_dir, args.jobs)
+        return
 
-for row_name, row_key_names in rows:
-    hdr(row_name)
-    for key_name in row_key_names:
-        print("# {}".format(key_name))
-        keycode = name_to_keycodes[key_name]
-        print_key(keycode, key_defs[keycode])
-        print()
+    name_to_keycodes = load_keycodes()
+    prelude, key_defs = parse_keymap(sys.stdin)
+    key_defs = apply_layer_overrides(key_defs, name_to_keycodes)
+    block_cache = None
+    if args.incremental:
+        block_cache = load_block_cache(args.incremental)
+    output = emit(prelude, key_defs, name_to_keycodes, block_cache)
+    if args.incremental:
+        save_block_cache(args.incremental, block_cache)
+    if args.stats:
+        for func in (keytrans, unicode_data):
+            info = func.cache_info()
+            print(
+                f"{func.__name__}: {info.hits} hits, {info.misses} misses, "
+                f"{info.currsize}/{info.maxsize} cached",
+                file=sys.stderr,
+            )
+    if args.output:
+        args.output.write_text(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Benchmark fmtmap's parse, override and emit phases on synthetic keymaps"""
+
+import argparse
+import io
+import random
+import string
+import time
+import tracemalloc
+
+import fmtmap
+
+
+SYMBOLS = [
+    *("+U+{:04x}".format(ord(c)) for c in string.ascii_letters),
+    *("U+{:04x}".format(ord(c)) for c in string.digits + string.punctuation),
+    "VoidSymbol",
+    "nul",
+    "Meta_nul",
+    "U+00e9",
+    "U+03b1",
+    "Escape",
+    "Tab",
+    "Control_a",
+    "Meta_b",
+]
+MODIFIERS = ["shift", "altgr", "control", "alt", "ctrll"]
+
+
+def stub_keycodes():
+    # Every name fmtmap looks up, numbered like the kernel would, without
+    # needing gcc or the kernel headers.
+    names = {"KEY_CAPSLOCK", "KEY_LEFTMETA", "KEY_SLASH", "KEY_BACKSPACE", "KEY_TAB"}
+    names.update(f"KEY_{i}" for i in range(10))
+    names.update(fmtmap.curnum_defs)
+    for _, row_key_names in fmtmap.rows:
+        names.update(row_key_names)
+    return {name: keycode for keycode, name in enumerate(sorted(names), 1)}
+
+
+def synthetic_keymap(lines, seed=0):
+    rng = random.Random(seed)
+    out = ["keymaps 0-127", "strings as usual"]
+    for keycode in range(1, lines + 1):
+        syms = [rng.choice(SYMBOLS) for _ in range(128)]
+        out.append(f"keycode {keycode} = {' '.join(syms)}")
+    # A sprinkling of single-column overrides, as dumpkeys produces.
+    for _ in range(lines // 10):
+        mods = rng.sample(MODIFIERS, rng.randint(1, 3))
+        keycode = rng.randint(1, lines)
+        out.append(f"{' '.join(mods)} keycode {keycode} = {rng.choice(SYMBOLS)}")
+    out.append("")
+    return "\n".join(out)
+
+
+def measure(func, repeat):
+    # Best-of-N wall time without tracing, then one traced run for peak memory.
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def bench_size(lines, repeat, name_to_keycodes):
+    text = synthetic_keymap(lines)
+
+    def parse():
+        fmtmap.keytrans.cache_clear()
+        return fmtmap.parse_keymap(io.StringIO(text))
+
+    (prelude, key_defs), parse_time, parse_peak = measure(parse, repeat)
+    yield "parse", lines, parse_time, parse_peak
+
+    def overrides():
+        return fmtmap.apply_layer_overrides(key_defs, name_to_keycodes)
+
+    key_defs, override_time, override_peak = measure(overrides, repeat)
+    yield "overrides", len(key_defs), override_time, override_peak
+
+    def single_symbol_maps():
+        for key_def in key_defs.values():
+            fmtmap.get_single_symbol_map(key_def[0])
+
+    _, ssm_time, ssm_peak = measure(single_symbol_maps, repeat)
+    yield "get_single_symbol_map", len(key_defs), ssm_time, ssm_peak
+
+    def print_keys():
+        fmtmap.unicode_data.cache_clear()
+        out = []
+        for keycode, key_def in key_defs.items():
+            fmtmap.print_key(out, keycode, key_def)
+        return out
+
+    _, print_time, print_peak = measure(print_keys, repeat)
+    yield "print_key", len(key_defs), print_time, print_peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Keycode lines per synthetic keymap",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Timed runs per phase (best is kept)"
+    )
+    args = parser.parse_args()
+
+    name_to_keycodes = stub_keycodes()
+    print(f"{'lines':>6} {'phase':<22} {'ops':>6} {'seconds':>9} {'ops/sec':>11} {'peak KiB':>9}")
+    for lines in args.sizes:
+        for phase, ops, seconds, peak in bench_size(lines, args.repeat, name_to_keycodes):
+            print(
+                f"{lines:>6} {phase:<22} {ops:>6} {seconds:>9.4f} "
+                f"{ops / seconds:>11.0f} {peak / 1024:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
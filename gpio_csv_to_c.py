@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
 import csv
 import dataclasses
 import enum
+import hashlib
+import io
+import json
+import pathlib
+import struct
 import sys
+from collections.abc import Callable
 
 
 class Direction(enum.Enum):
@@ -19,68 +27,439 @@ class Level(enum.Enum):
     HIGH = 1
 
 
-@dataclasses.dataclass
+# Name <-> value tables for the enums above.  GPIO records store the small
+# int values, and parsing looks names up here instead of going through
+# Enum[...] for every row.
+DIRECTION_VALUES = {member.name: member.value for member in Direction}
+FUNCTION_VALUES = {member.name: member.value for member in Function}
+LEVEL_VALUES = {member.name: member.value for member in Level}
+DIRECTION_NAMES = {value: name for name, value in DIRECTION_VALUES.items()}
+FUNCTION_NAMES = {value: name for name, value in FUNCTION_VALUES.items()}
+LEVEL_NAMES = {value: name for name, value in LEVEL_VALUES.items()}
+
+
+@dataclasses.dataclass(slots=True)
 class GPIO:
     num: int
     nf: str
     net: str
-    direction: Direction
-    function: Function
-    level: Level
+    direction: int
+    function: int
+    level: int
+    line: int
+
+
+def parse_sets(spec):
+    # Inclusive pad ranges, e.g. "0-31,32-63,64-75".  A pad may only belong
+    # to one set, so overlapping ranges are rejected along with reversed
+    # and malformed ones.
+    sets = []
+    for part in spec.split(","):
+        start, _, end = part.partition("-")
+        try:
+            s_rng = range(int(start), int(end or start) + 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"malformed range {part!r}") from None
+        if not s_rng:
+            raise argparse.ArgumentTypeError(f"reversed range {part!r}")
+        for s_idx, other in enumerate(sets):
+            if s_rng.start < other.stop and other.start < s_rng.stop:
+                raise argparse.ArgumentTypeError(
+                    f"range {part!r} overlaps set {s_idx + 1} "
+                    f"({other.start}-{other.stop - 1})")
+        sets.append(s_rng)
+    return sets
 
 
-input()
-gpios = []
-reader = csv.reader(sys.stdin)
-for row in reader:
-    num = int(row[0])
-    nf = row[2]
-    net = row[3]
-    direction = Direction[row[4]]
-    function = Function[row[5]]
-    level = Level[row[6]]
-    gpios.append(GPIO(num, nf, net, direction, function, level))
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
 
-sets = [range(0, 32), range(32, 64), range(64, 76)]
 
-print("/* SPDX-License-Identifier: GPL-2.0-only */")
-print()
-print("#include <southbridge/intel/common/gpio.h>")
+def read_gpios(stream):
+    stream.readline()
+    gpios = []
+    reader = csv.reader(stream)
+    for row in reader:
+        # line_num starts over after the header readline() above.
+        line = reader.line_num + 1
+        try:
+            num = int(row[0])
+            nf = sys.intern(row[2])
+            net = row[3]
+            direction = DIRECTION_VALUES[row[4]]
+            function = FUNCTION_VALUES[row[5]]
+            level = LEVEL_VALUES[row[6]]
+        except (ValueError, KeyError, IndexError) as e:
+            raise ValueError(f"line {line}: bad row {row!r} ({e!r})") from None
+        gpios.append(GPIO(num, nf, net, direction, function, level, line))
+    return gpios
 
 
-for s_idx, s_rng in enumerate(sets):
-    print()
-    print(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_mode = {{")
+def index_sets(sets):
+    return {num: s_idx for s_idx, s_rng in enumerate(sets) for num in s_rng}
+
+
+def validate(gpios, sets):
+    # One pass indexes the CSV lines by pad number and the pads by net name.
+    # Duplicate pads and pads outside every set would silently produce broken
+    # C, so they are errors.  Shared nets and gaps in a set are only warnings.
+    set_of_pad = index_sets(sets)
+    lines_by_pad = {}
+    pads_by_net = {}
     for gpio in gpios:
-        if gpio.num not in s_rng:
-            continue
-        print(f"\t.gpio{gpio.num:<2} = GPIO_MODE_{gpio.function.name + ',':<7} // Net: {gpio.net + ',':<19} NF: {gpio.nf}")
-    print("};")
+        seen = gpio.num in lines_by_pad
+        lines_by_pad.setdefault(gpio.num, []).append(gpio.line)
+        if gpio.net and not seen:
+            pads_by_net.setdefault(gpio.net, []).append(gpio.num)
 
-    print()
-    print(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_direction = {{")
+    errors = []
+    warnings = []
+    for num, lines in lines_by_pad.items():
+        if len(lines) > 1:
+            errors.append({"kind": "duplicate_pad", "pad": num, "lines": lines})
+        if num not in set_of_pad:
+            errors.append({"kind": "unassigned_pad", "pad": num, "lines": lines})
+    for net, pads in pads_by_net.items():
+        if len(pads) > 1:
+            warnings.append({"kind": "duplicate_net", "net": net, "pads": pads})
+    for s_idx, s_rng in enumerate(sets):
+        missing = [num for num in s_rng if num not in lines_by_pad]
+        if missing:
+            warnings.append({"kind": "gap", "set": s_idx + 1, "pads": missing})
+    return {"errors": errors, "warnings": warnings}
+
+
+def bucket_gpios(gpios, sets):
+    # Sort the GPIOs into their sets in one pass.
+    set_of_pad = index_sets(sets)
+    buckets = [[] for _ in sets]
     for gpio in gpios:
-        if gpio.num not in s_rng:
-            continue
-        print(f"\t.gpio{gpio.num:<2} = GPIO_DIR_{gpio.direction.name},")
-    print("};")
+        s_idx = set_of_pad.get(gpio.num)
+        if s_idx is not None:
+            buckets[s_idx].append(gpio)
+    return buckets
+
+
+def render(gpios, sets):
+    out = []
+    out.append("/* SPDX-License-Identifier: GPL-2.0-only */")
+    out.append("")
+    out.append("#include <southbridge/intel/common/gpio.h>")
+
+    for s_idx, bucket in enumerate(bucket_gpios(gpios, sets)):
+        out.append("")
+        out.append(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_mode = {{")
+        for gpio in bucket:
+            out.append(f"\t.gpio{gpio.num:<2} = GPIO_MODE_{FUNCTION_NAMES[gpio.function] + ',':<7} // Net: {gpio.net + ',':<19} NF: {gpio.nf}")
+        out.append("};")
+
+        out.append("")
+        out.append(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_direction = {{")
+        for gpio in bucket:
+            out.append(f"\t.gpio{gpio.num:<2} = GPIO_DIR_{DIRECTION_NAMES[gpio.direction]},")
+        out.append("};")
 
-    print()
-    print(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_level = {{")
+        out.append("")
+        out.append(f"static const struct pch_gpio_set{s_idx+1} pch_gpio_set{s_idx+1}_level = {{")
+        for gpio in bucket:
+            out.append(f"\t.gpio{gpio.num:<2} = GPIO_LEVEL_{LEVEL_NAMES[gpio.level]},")
+        out.append("};")
+
+    out.append("")
+    out.append("const struct pch_gpio_map mainboard_gpio_map = {")
+    for s_idx in range(len(sets)):
+        out.append(f"\t.set{s_idx + 1} = {{")
+        for table in ("mode", "direction", "level"):
+            xtab = "\t"
+            if table == "direction":
+                xtab = ""
+            out.append(f"\t\t.{table}{xtab}\t= &pch_gpio_set{s_idx+1}_{table},")
+        out.append("\t},")
+    out.append("};")
+    out.append("")
+    return "\n".join(out)
+
+
+def render_json(gpios, sets):
+    set_of_pad = index_sets(sets)
+    return json.dumps(
+        {
+            "sets": [[s_rng.start, s_rng.stop - 1] for s_rng in sets],
+            "gpios": [
+                {
+                    "num": gpio.num,
+                    "set": set_of_pad[gpio.num] + 1,
+                    "nf": gpio.nf,
+                    "net": gpio.net,
+                    "direction": DIRECTION_NAMES[gpio.direction],
+                    "function": FUNCTION_NAMES[gpio.function],
+                    "level": LEVEL_NAMES[gpio.level],
+                }
+                for gpio in gpios
+            ],
+        },
+        indent=2,
+    ) + "\n"
+
+
+# Little endian: magic, format version, pad count, then one entry per pad
+# with its number, 1-based set, and flags (bit 0 direction, bit 1 function,
+# bit 2 level, each the enum value).
+BLOB_HEADER = struct.Struct("<4sHH")
+BLOB_ENTRY = struct.Struct("<HBB")
+
+
+def render_blob(gpios, sets):
+    set_of_pad = index_sets(sets)
+    blob = bytearray(BLOB_HEADER.pack(b"GPIO", 1, len(gpios)))
     for gpio in gpios:
-        if gpio.num not in s_rng:
+        flags = gpio.direction | gpio.function << 1 | gpio.level << 2
+        blob += BLOB_ENTRY.pack(gpio.num, set_of_pad[gpio.num] + 1, flags)
+    return bytes(blob)
+
+
+def render_dts(gpios, sets):
+    # Each set is one Zephyr GPIO controller (&gpio0, &gpio1, ...), with pins
+    # numbered from the start of its range.  Pads in GPIO mode become
+    # gpio-hogs; native-function pads are pinctrl's business and left out.
+    out = []
+    out.append("/* SPDX-License-Identifier: GPL-2.0-only */")
+    out.append("")
+    out.append("#include <zephyr/dt-bindings/gpio/gpio.h>")
+
+    for s_idx, bucket in enumerate(bucket_gpios(gpios, sets)):
+        hogs = [gpio for gpio in bucket if gpio.function == FUNCTION_VALUES["GPIO"]]
+        if not hogs:
             continue
-        print(f"\t.gpio{gpio.num:<2} = GPIO_LEVEL_{gpio.level.name},")
-    print("};")
-
-print()
-print("const struct pch_gpio_map mainboard_gpio_map = {")
-for s_idx in range(len(sets)):
-    print(f"\t.set{s_idx + 1} = {{")
-    for table in ("mode", "direction", "level"):
-        xtab = "\t"
-        if table == "direction":
-            xtab = ""
-        print(f"\t\t.{table}{xtab}\t= &pch_gpio_set{s_idx+1}_{table},")
-    print("\t},")
-print("};")
+        out.append("")
+        out.append(f"&gpio{s_idx} {{")
+        for gpio in hogs:
+            if gpio.direction == DIRECTION_VALUES["INPUT"]:
+                state = "input"
+            else:
+                state = f"output-{LEVEL_NAMES[gpio.level].lower()}"
+            out.append(f"\tpad{gpio.num} {{")
+            out.append("\t\tgpio-hog;")
+            out.append(f"\t\tgpios = <{gpio.num - sets[s_idx].start} GPIO_ACTIVE_HIGH>;")
+            out.append(f"\t\t{state};")
+            out.append(f'\t\tline-name = "{gpio.net}";')
+            out.append("\t};")
+        out.append("};")
+    out.append("")
+    return "\n".join(out)
+
+
+@dataclasses.dataclass(frozen=True)
+class Emitter:
+    suffix: str
+    render: Callable
+
+
+# Output formats, all rendered from the same parsed GPIO list.
+EMITTERS = {
+    "c": Emitter(".c", render),
+    "json": Emitter(".json", render_json),
+    "blob": Emitter(".bin", render_blob),
+    "dts": Emitter(".overlay", render_dts),
+}
+
+
+def convert(stream, sets, formats=("c",)):
+    # Returns ({format: output}, validation report); nothing is rendered when
+    # the report has errors, which include a CSV that doesn't parse.
+    try:
+        gpios = read_gpios(stream)
+    except ValueError as e:
+        return None, {"errors": [{"kind": "parse_error", "message": str(e)}], "warnings": []}
+    report = validate(gpios, sets)
+    if report["errors"]:
+        return None, report
+    return {fmt: EMITTERS[fmt].render(gpios, sets) for fmt in formats}, report
+
+
+def write_output(path, data):
+    if isinstance(data, bytes):
+        path.write_bytes(data)
+    else:
+        path.write_text(data)
+
+
+BATCH_STATE_NAME = ".gpio_csv_to_c.json"
+
+
+def find_csvs(path):
+    # A directory is searched for CSVs; any other file is a manifest listing
+    # one CSV per line, relative to the manifest.
+    if path.is_dir():
+        return sorted(path.rglob("*.csv")), path / BATCH_STATE_NAME
+    csvs = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            csvs.append(path.parent / line)
+    return csvs, path.parent / BATCH_STATE_NAME
+
+
+def batch_outputs(csv_path, formats):
+    return [csv_path.parent / f"gpio{EMITTERS[fmt].suffix}" for fmt in formats]
+
+
+def convert_file(csv_path, data, sets, formats):
+    try:
+        text = data.decode()
+    except UnicodeDecodeError as e:
+        return None, {"errors": [{"kind": "parse_error", "message": str(e)}], "warnings": []}
+    results, report = convert(io.StringIO(text, newline=None), sets, formats)
+    if results is None:
+        return None, report
+    outputs = batch_outputs(csv_path, formats)
+    for output, fmt in zip(outputs, formats):
+        write_output(output, results[fmt])
+    return outputs, report
+
+
+def run_batch(paths, sets, formats=("c",), jobs=None):
+    # Returns the validation reports of the converted CSVs, keyed by path.
+    # The CSV's hash covers the set ranges, the formats and this script too,
+    # as any of them can change the output.
+    salt = hashlib.sha256(pathlib.Path(__file__).read_bytes())
+    salt.update(repr([(s.start, s.stop) for s in sets]).encode())
+    salt.update(repr(sorted(formats)).encode())
+
+    reports = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for path in paths:
+            csvs, state_path = find_csvs(path)
+            try:
+                state = json.loads(state_path.read_text())
+            except (OSError, ValueError):
+                state = {}
+
+            claimed = {}
+            futures = {}
+            for csv_path in csvs:
+                if csv_path.parent in claimed:
+                    raise SystemExit(
+                        f"{csv_path} and {claimed[csv_path.parent]} would both write "
+                        f"to {csv_path.parent}")
+                claimed[csv_path.parent] = csv_path
+
+                data = csv_path.read_bytes()
+                hasher = salt.copy()
+                hasher.update(data)
+                digest = hasher.hexdigest()
+                key = str(csv_path.resolve())
+                if state.get(key) == digest and all(
+                        output.exists() for output in batch_outputs(csv_path, formats)):
+                    continue
+                future = executor.submit(convert_file, csv_path, data, sets, formats)
+                futures[future] = key, digest
+
+            for future in concurrent.futures.as_completed(futures):
+                key, digest = futures[future]
+                try:
+                    outputs, reports[key] = future.result()
+                except Exception as e:
+                    # Don't let one board lose the state of all the others.
+                    outputs = None
+                    reports[key] = {
+                        "errors": [{"kind": "exception", "message": repr(e)}],
+                        "warnings": [],
+                    }
+                if outputs is None:
+                    # Leave it out of the state so it is retried next time.
+                    # Whatever gpio.* is next to it stays: it may be tracked
+                    # source rather than an earlier output of ours.
+                    state.pop(key, None)
+                    continue
+                for output in outputs:
+                    print(output, file=sys.stderr)
+                state[key] = digest
+            state_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a GPIO CSV on stdin to coreboot C and other formats.")
+    parser.add_argument(
+        "--sets",
+        type=parse_sets,
+        default="0-31,32-63,64-75",
+        help="Comma-separated inclusive pad ranges, one per GPIO set",
+    )
+    parser.add_argument(
+        "--batch",
+        type=pathlib.Path,
+        nargs="+",
+        metavar="PATH",
+        help="Directories of CSVs, or manifests listing CSVs; writes gpio.* next to each",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="formats",
+        action="append",
+        choices=[*EMITTERS, "all"],
+        help="Output format, may be repeated (default: c)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        metavar="PREFIX",
+        help="Write each format to PREFIX plus its suffix instead of stdout",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=positive_int, help="Number of batch worker processes")
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="Write the JSON validation report (errors and warnings) here",
+    )
+    args = parser.parse_args()
+
+    formats = args.formats or ["c"]
+    if "all" in formats:
+        formats = list(EMITTERS)
+    formats = list(dict.fromkeys(formats))
+    if len(formats) > 1 and not args.batch and not args.output:
+        parser.error("more than one --format needs --output")
+
+    if args.batch:
+        reports = run_batch(args.batch, args.sets, formats, args.jobs)
+        failed = any(report["errors"] for report in reports.values())
+        notices = {
+            path: {kind: items for kind, items in report.items() if items}
+            for path, report in reports.items()
+            if report["errors"] or report["warnings"]
+        }
+    else:
+        results, report = convert(sys.stdin, args.sets, formats)
+        reports = report
+        failed = bool(report["errors"])
+        notices = {kind: items for kind, items in report.items() if items}
+
+    if args.report:
+        args.report.write_text(json.dumps(reports, indent=2) + "\n")
+    if notices:
+        json.dump(notices, sys.stderr, indent=2)
+        print(file=sys.stderr)
+    if failed:
+        sys.exit(1)
+    if args.batch:
+        return
+    if args.output:
+        for fmt, data in results.items():
+            write_output(args.output.with_name(args.output.name + EMITTERS[fmt].suffix), data)
+    elif isinstance(results[formats[0]], bytes):
+        sys.stdout.buffer.write(results[formats[0]])
+    else:
+        sys.stdout.write(results[formats[0]])
+
+
+if __name__ == "__main__":
+    main()